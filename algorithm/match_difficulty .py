@@ -7,6 +7,33 @@ such as rivalry, attendance, importance, weather, and team behaviour.
 This helps adjust referee performance scores for fairness.
 """
 
+from functools import lru_cache
+from operator import itemgetter
+
+import numpy as np
+
+# --- Fixed Weights (can be tuned later) ---
+MDR_WEIGHTS = {
+    'importance': 0.30,
+    'rivalry': 0.25,
+    'attendance': 0.15,
+    'fouls': 0.10,
+    'var': 0.10,
+    'dissent': 0.05,
+    'weather': 0.03,
+    'fixture_history': 0.02
+}
+
+# --- Scale to multiplier (1.0 = normal, up to 1.8 = very difficult) ---
+MDR_SCALE = 0.8
+
+# Pulls all eight inputs out of match_data in one call, in MDR_WEIGHTS order
+_get_mdr_inputs = itemgetter(*MDR_WEIGHTS)
+
+# Weights resolved once into the same fixed order
+_MDR_WEIGHT_VALUES = tuple(MDR_WEIGHTS.values())
+
+
 def compute_match_difficulty(match_data):
     """
     Computes a Match Difficulty Rating (MDR) for a given match.
@@ -23,26 +50,78 @@ def compute_match_difficulty(match_data):
     }
     """
 
-    # --- Fixed Weights (can be tuned later) ---
-    weights = {
-        'importance': 0.30,
-        'rivalry': 0.25,
-        'attendance': 0.15,
-        'fouls': 0.10,
-        'var': 0.10,
-        'dissent': 0.05,
-        'weather': 0.03,
-        'fixture_history': 0.02
+    values = _get_mdr_inputs(match_data)
+    try:
+        mdr_score, mdr_multiplier = _mdr_core(values)
+    except TypeError:
+        # Unhashable inputs (e.g. Series from a DataFrame) skip the cache
+        mdr_score, mdr_multiplier = _mdr_core.__wrapped__(values)
+
+    return {
+        "mdr_score": mdr_score,
+        "mdr_multiplier": mdr_multiplier
     }
 
+
+@lru_cache(maxsize=4096)
+def _mdr_core(values):
+    # Pure numeric core, memoised on the exact input tuple so repeated
+    # fixtures (several referees, same match context) are only scored once
+
     # --- Weighted sum of all components ---
-    mdr_score = sum(match_data[key] * weights[key] for key in weights)
+    mdr_score = sum(v * w for v, w in zip(values, _MDR_WEIGHT_VALUES))
 
-    # --- Scale to multiplier (1.0 = normal, up to 1.8 = very difficult) ---
-    mdr_multiplier = 1.0 + (mdr_score * 0.8)
+    return round(mdr_score, 3), round(_mdr_multiplier(mdr_score), 3)
+
+
+def _mdr_multiplier(mdr_score):
+    # Shared by the scalar and batch paths; works on floats and NumPy arrays
+    return 1.0 + (mdr_score * MDR_SCALE)
+
+
+def compute_match_difficulty_batch(matches):
+    """
+    Vectorised version of compute_match_difficulty for many matches at once.
+
+    matches is a DataFrame (or dict of arrays) with the same keys as
+    match_data above, one row per match. Returns arrays of length N.
+    """
+
+    # --- Weighted sum, term by term in MDR_WEIGHTS order like _mdr_core ---
+    # (accumulated in place into one buffer; a matmul would reorder the
+    # additions and move scores that sit on a rounding tie)
+    columns = [np.asarray(matches[key], dtype=float) for key in MDR_WEIGHTS]
+    mdr_score = np.zeros(len(columns[0]))
+    for column, weight in zip(columns, _MDR_WEIGHT_VALUES):
+        mdr_score += column * weight
 
     return {
-        "mdr_score": round(mdr_score, 3),
-        "mdr_multiplier": round(mdr_multiplier, 3)
+        "mdr_score": _round_like_builtin(mdr_score, 3),
+        "mdr_multiplier": _round_like_builtin(_mdr_multiplier(mdr_score), 3)
     }
 
+
+def _round_like_builtin(values, ndigits):
+    # np.round with round()'s results, so the batch path rounds exactly like
+    # the scalar one: np.round scales by 10**ndigits first and can send a
+    # decimal tie the other way, so values near a tie go through round()
+    out = np.round(values, ndigits)
+    scaled = values * 10.0 ** ndigits
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        out[near_tie] = [round(v, ndigits) for v in values[near_tie].tolist()]
+    return out
+
+
+if __name__ == "__main__":
+    # Parity check: the batch path must give exactly the scalar results,
+    # including scores that land on a 3-dp rounding tie
+    rng = np.random.default_rng(0)
+    n = 50_000
+    matches = {key: np.round(rng.uniform(0, 1, n), 2) for key in MDR_WEIGHTS}
+    batch = compute_match_difficulty_batch(matches)
+    for i in range(n):
+        scalar = compute_match_difficulty({key: float(col[i]) for key, col in matches.items()})
+        for key, value in scalar.items():
+            assert batch[key][i] == value, (i, key, batch[key][i], value)
+    print(f"compute_match_difficulty_batch matches the scalar path on {n} matches")
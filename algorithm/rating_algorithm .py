@@ -2,8 +2,12 @@
 # Full professional referee rating model with behaviour indicators,
 # difficulty scaling, consistency, form, and season averages.
 
+from collections import deque
+from operator import itemgetter, mul
+
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 # ============================================================
@@ -20,9 +24,10 @@ BEHAVIOUR_DEFAULTS = {
 }
 
 def ensure_behaviour_columns(df):
-    for col, val in BEHAVIOUR_DEFAULTS.items():
-        if col not in df.columns:
-            df[col] = val
+    missing = {col: val for col, val in BEHAVIOUR_DEFAULTS.items() if col not in df.columns}
+    if missing:
+        # One multi-column insert (still in place) instead of one per column
+        df[list(missing)] = pd.DataFrame(missing, index=df.index)
     return df
 
 
@@ -30,18 +35,29 @@ def ensure_behaviour_columns(df):
 # 2. MATCH DIFFICULTY SCORE (MDS)
 # ============================================================
 
+MDS_COLS = [
+    "crowd_pressure",
+    "attendance_pct",
+    "rivalry_intensity",
+    "match_importance",
+    "VARF",
+    "CPR"
+]
+MDS_WEIGHTS = (0.20, 0.15, 0.20, 0.20, 0.10, 0.10)
+mds_inputs = itemgetter(*MDS_COLS)
+
 def compute_match_difficulty(row):
-    mds = (
-        0.20 * row["crowd_pressure"] +
-        0.15 * row["attendance_pct"] +
-        0.20 * row["rivalry_intensity"] +
-        0.20 * row["match_importance"] +
-        0.10 * row["VARF"] +
-        0.10 * row["CPR"]
-    )
-    return max(0.0, min(1.0, mds))
+    # Summed term by term in MDS_COLS order; compute_final_ratings adds the
+    # columns in the same order, so both paths agree on the mode boundaries
+    mds = sum(map(mul, MDS_WEIGHTS, mds_inputs(row)))
+    # max(0.0, min(1.0, mds)) without the builtin calls; written in the same
+    # comparison order, so NaN still ends up at 1.0
+    mds = mds if mds < 1.0 else 1.0
+    return mds if mds > 0.0 else 0.0
 
 
+DIFFICULTY_MODES = ["easy", "medium", "hard"]
+
 def difficulty_category(mds):
     if mds < 0.45:
         return "easy"
@@ -51,6 +67,14 @@ def difficulty_category(mds):
         return "medium"
 
 
+def difficulty_codes(mds):
+    # Vectorised difficulty_category: int8 codes indexing DIFFICULTY_MODES
+    # (0 easy, 1 medium, 2 hard) for a whole array of MDS values. Uses the
+    # same comparisons, so NaN maps to "medium" exactly as it does there.
+    mds = np.asarray(mds)
+    return (~(mds < 0.45)).astype(np.int8) + (mds > 0.55)
+
+
 # ============================================================
 # 3. BASE WEIGHTS (per difficulty mode)
 # ============================================================
@@ -85,14 +109,21 @@ BASE_WEIGHTS = {
     }
 }
 
+# Fixed column order used by the vectorised path (matches the dict order above)
+FEATURE_ORDER = list(BASE_WEIGHTS["easy"].keys())
+
+# (3, 7) table: one row per difficulty mode, columns in FEATURE_ORDER
+BASE_WEIGHTS_ARR = np.array([
+    [BASE_WEIGHTS[mode][f] for f in FEATURE_ORDER]
+    for mode in DIFFICULTY_MODES
+])
+
 
 # ============================================================
 # 4. APPLY BEHAVIOURAL MODIFIERS TO WEIGHTS
 # ============================================================
 
 def apply_behaviour_modifiers(row, weights):
-    w = weights.copy()
-
     # Behaviour modifiers
     modifier = {
         "foul_management": row["FvX"],                  # strictness
@@ -102,9 +133,8 @@ def apply_behaviour_modifiers(row, weights):
         "decision_accuracy": 1 - row["TTD"] * 0.1       # hesitation penalty
     }
 
-    # Apply modifiers
-    for f in w:
-        w[f] *= modifier.get(f, 1.0)
+    # Apply modifiers (builds the adjusted dict directly, no copy first)
+    w = {f: v * modifier.get(f, 1.0) for f, v in weights.items()}
 
     # Normalise back to sum=1
     total = sum(w.values())
@@ -118,13 +148,15 @@ def apply_behaviour_modifiers(row, weights):
 # 5. ERROR SEVERITY INDEX (ESI) WITH DIFFICULTY SCALING
 # ============================================================
 
-def compute_scaled_ESI(row):
-    base_penalty = (
-        row["minor_errors"] * -0.05 +
-        row["moderate_errors"] * -0.15 +
-        row["major_errors"] * -0.40
-    )
-    mds = compute_match_difficulty(row)
+ERROR_COLS = ["minor_errors", "moderate_errors", "major_errors"]
+ERROR_WEIGHTS = (-0.05, -0.15, -0.40)
+error_counts = itemgetter(*ERROR_COLS)
+
+def compute_scaled_ESI(row, mds=None):
+    base_penalty = sum(map(mul, error_counts(row), ERROR_WEIGHTS))
+    # Reuse the caller's MDS when it already has one
+    if mds is None:
+        mds = compute_match_difficulty(row)
     penalty = base_penalty * (0.5 + mds)
     return penalty
 
@@ -153,85 +185,228 @@ def compute_final_rating(row):
     adjusted_w = apply_behaviour_modifiers(row, base_w)
 
     base = compute_base_rating(row, adjusted_w)
-    esi_penalty = compute_scaled_ESI(row)
+    esi_penalty = compute_scaled_ESI(row, mds)
 
-    final = base + esi_penalty
-    final = max(1.0, min(10.0, round(final, 2)))
+    final = round(base + esi_penalty, 2)
+    final = final if final < 10.0 else 10.0   # max(1.0, min(10.0, final)),
+    final = final if final > 1.0 else 1.0     # NaN included
 
     return final, mds, mode
 
 
+def compute_final_ratings(df):
+    # Same maths as compute_final_rating, evaluated over whole columns at once.
+    # Every sum runs term by term in the scalar path's order (MDS and ESI are
+    # accumulated into one buffer column by column; NumPy adds a row of 7 left
+    # to right), so the results are bit-for-bit the scalar ones.
+    n = len(df)
+    mds = np.zeros(n)
+    for c, wt in zip(MDS_COLS, MDS_WEIGHTS):
+        mds += wt * df[c].to_numpy(dtype=float)
+    # fmin/fmax (unlike np.clip) send NaN to the upper bound, as max/min do;
+    # both run in place, so clamping allocates nothing
+    np.fmin(mds, 1.0, out=mds)
+    np.fmax(mds, 0.0, out=mds)
+    mode_idx = difficulty_codes(mds)
+
+    # Base weights per row, picked by integer difficulty mode -> (N, 7)
+    w = BASE_WEIGHTS_ARR.take(mode_idx, axis=0)
+
+    # Behaviour modifiers, applied in place to their weight columns
+    # (features without a modifier keep a factor of 1)
+    behaviour = df[["FvX", "VARF", "HBI", "CPR", "TTD"]].to_numpy(dtype=float)
+    fvx, varf, hbi, cpr, ttd = behaviour.T
+    col = FEATURE_ORDER.index
+    w[:, col("foul_management")] *= fvx                 # strictness
+    w[:, col("crowd_pressure")] *= 1 + cpr * 0.2        # pressure reaction
+    w[:, col("var_overturns")] *= 1 + varf * 0.3        # VAR dependence
+    w[:, col("attendance_pct")] *= 1 + hbi * 0.2        # home bias
+    w[:, col("decision_accuracy")] *= 1 - ttd * 0.1     # hesitation penalty
+    w /= w.sum(axis=1, keepdims=True)
+
+    # Missing feature columns count as 0, like row.get(feature, 0)
+    X = df.reindex(columns=FEATURE_ORDER, fill_value=0).to_numpy(dtype=float)
+    base = (X * w * 10).sum(axis=1)
+
+    esi_penalty = np.zeros(n)
+    for c, wt in zip(ERROR_COLS, ERROR_WEIGHTS):
+        esi_penalty += df[c].to_numpy(dtype=float) * wt
+    esi_penalty *= 0.5 + mds
+
+    # Add base into the ESI buffer and clamp it in place (no extra
+    # temporaries). Rounding is left to rate_dataframe's output columns.
+    final = esi_penalty
+    final += base
+    np.fmin(final, 10.0, out=final)
+    np.fmax(final, 1.0, out=final)
+    return final, mds, mode_idx
+
+
 # ============================================================
 # 8. CONSISTENCY BONUS
 # ============================================================
 
-def compute_consistency_bonus(df):
-    bonuses = {}
-    for ref in df["referee"].unique():
-        ref_df = df[df["referee"] == ref].sort_values("match_id")
-        rolling_std = ref_df["final_rating"].rolling(5).std()
+# Rolling-std upper bound -> bonus; anything above the last bound gets the fallback
+CONSISTENCY_BANDS = [(0.15, 0.20), (0.30, 0.10), (0.50, 0.00)]
+CONSISTENCY_FALLBACK = -0.15
+
+# The same bounds on 5·Σx² − (Σx)² over a window of ratings in integer
+# hundredths, which is 5 · 4 · 100² times the variance: std < limit is
+# exactly spread < 200000 · limit²
+CONSISTENCY_SPREAD_LIMITS = [round(200000 * limit ** 2) for limit, _ in CONSISTENCY_BANDS]
+
+def consistency_band_bonus(windows):
+    # Bonus for each 5-match window (last axis) of 2-dp ratings. The band test
+    # runs on integer hundredths, so it is exact: a window whose std is exactly
+    # a band limit (7.00, 7.00, 7.15, 7.30, 7.30 -> 0.15) always falls in the
+    # next band, where a float std can land on either side of the limit.
+    # Shared by compute_consistency_bonus and ConsistencyBonusState.
+    k = np.rint(np.asarray(windows, dtype=float) * 100).astype(np.int64)
+    spread = 5 * (k * k).sum(axis=-1) - k.sum(axis=-1) ** 2
+    return np.select(
+        [spread < limit for limit in CONSISTENCY_SPREAD_LIMITS],
+        [b for _, b in CONSISTENCY_BANDS],
+        default=CONSISTENCY_FALLBACK
+    )
+
+
+def referee_match_order(df):
+    # Row positions that put df in (referee, match_id) order. Only the two key
+    # columns are sorted, not the whole frame.
+    keys = df[["referee", "match_id"]].reset_index(drop=True)
+    return keys.sort_values(["referee", "match_id"], kind="stable").index.to_numpy()
+
 
-        for idx, std in zip(ref_df.index, rolling_std):
-            if np.isnan(std):
-                bonuses[idx] = 0
-            elif std < 0.15:
-                bonuses[idx] = 0.20
-            elif std < 0.30:
-                bonuses[idx] = 0.10
-            elif std < 0.50:
-                bonuses[idx] = 0.00
-            else:
-                bonuses[idx] = -0.15
-    return bonuses
+def sorted_ratings(df, order):
+    # final_rating and integer referee codes, both in (referee, match_id) order
+    values = df["final_rating"].to_numpy(dtype=float)[order]
+    referees = df["referee"].astype("category").cat.codes.to_numpy()[order]
+    return values, referees
+
+
+def rolling_rating_stat(df, order, stat):
+    # Rolling 5-match statistic of final_rating per referee, returned as an
+    # array in df's row order. Windows come from one strided view over the
+    # sorted column; any window reaching back into the previous referee's
+    # matches (first 4 of each referee) is masked to NaN.
+    values, referees = sorted_ratings(df, order)
+
+    out = np.full(len(values), np.nan)
+    if len(values) >= 5:
+        out[4:] = stat(sliding_window_view(values, 5))
+        out[4:][referees[4:] != referees[:-4]] = np.nan
+
+    result = np.empty_like(out)
+    result[order] = out
+    return result
+
+
+def compute_consistency_bonus(df, order=None):
+    if order is None:
+        order = referee_match_order(df)
+
+    bonus = rolling_rating_stat(df, order, consistency_band_bonus)
+    bonus[np.isnan(bonus)] = 0.0   # fewer than 5 matches so far
+
+    return bonus
+
+
+class ConsistencyBonusState:
+    # Streaming version of compute_consistency_bonus for append-only feeds:
+    # keeps each referee's last five pre-bonus ratings, so scoring a new match
+    # is O(1) instead of re-running the rolling window over the whole history.
+    # Matches must be fed per referee in match_id order.
+
+    def __init__(self):
+        self.recent = {}
+
+    def update(self, referee, final_rating):
+        window = self.recent.get(referee)
+        if window is None:
+            window = self.recent[referee] = deque(maxlen=5)
+        window.append(final_rating)
+
+        if len(window) < 5:
+            return 0.0   # fewer than 5 matches so far
+
+        return float(consistency_band_bonus(window))
 
 
 # ============================================================
 # 9. FORM + SEASON AVERAGE
 # ============================================================
 
-def compute_form_and_season(df):
-    form_map = {}
-    season_map = {}
+def compute_form_and_season(df, order=None):
+    if order is None:
+        order = referee_match_order(df)
+
+    form = rolling_rating_stat(df, order, lambda w: w.mean(axis=1))
 
-    for ref in df["referee"].unique():
-        matches = df[df["referee"] == ref].sort_values("match_id")
-        season_map[ref] = round(matches["final_rating"].mean(), 2)
+    # Season mean per referee: ndarray.sum over that referee's ratings in
+    # match_id order, divided by the count - the same float operations as
+    # Series.mean in the old per-referee loop. groupby().mean() uses
+    # compensated summation instead, which rounds .xx5 averages differently.
+    values, referees = sorted_ratings(df, order)
+    starts = np.flatnonzero(np.r_[True, referees[1:] != referees[:-1]])
+    counts = np.diff(np.r_[starts, len(values)])
+    means = np.array([seg.sum() for seg in np.split(values, starts[1:])]) / counts
 
-        rolling = matches["final_rating"].rolling(5).mean()
-        for idx, val in zip(matches.index, rolling):
-            form_map[idx] = round(val, 2) if not np.isnan(val) else None
+    season = np.empty(len(values))
+    season[order] = np.repeat(means, counts)
 
-    return form_map, season_map
+    return form, season
 
 
 # ============================================================
 # 10. MASTER FUNCTION
 # ============================================================
 
+def round_like_builtin(values, ndigits):
+    # np.round over an array, but with round()'s results: np.round scales by
+    # 10**ndigits first, so a value on a decimal tie can go the other way
+    # (5.945 -> 5.94, where round() gives 5.95). Away from ties the two
+    # agree, so only the few values near one are passed to round() itself.
+    values = np.asarray(values, dtype=float)
+    out = np.round(values, ndigits)
+    scaled = values * 10.0 ** ndigits
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        out[near_tie] = [round(v, ndigits) for v in values[near_tie].tolist()]
+    return out
+
+
 def rate_dataframe(df):
+    # Works in place: missing behaviour defaults and the output columns are
+    # written straight into the caller's DataFrame, which is also returned.
+    # No copy is taken - pass df.copy() if the input must stay untouched.
+    # "referee" is converted to a categorical so sorting and grouping run on
+    # integer codes rather than hashing strings.
 
     df = ensure_behaviour_columns(df)
+    df["referee"] = df["referee"].astype("category")
 
-    # STEP 1 — apply base rating
-    finals, mds_list, mode_list = [], [], []
-    for _, row in df.iterrows():
-        final, mds, mode = compute_final_rating(row)
-        finals.append(final)
-        mds_list.append(mds)
-        mode_list.append(mode)
+    # STEP 1 — apply base rating (vectorised over all rows)
+    finals, mds, mode_idx = compute_final_ratings(df)
+
+    # Ratings and form are rounded with round()'s rules, as the per-row code
+    # did; season averages were rounded as NumPy floats, i.e. by np.round
+    df["final_rating"] = round_like_builtin(finals, 2)
+    df["mds"] = mds
+    df["difficulty_mode"] = pd.Categorical.from_codes(
+        mode_idx, categories=DIFFICULTY_MODES
+    )
 
-    df["final_rating"] = finals
-    df["mds"] = mds_list
-    df["difficulty_mode"] = mode_list
+    # Sort keys once; steps 2 and 3 both work in (referee, match_id) order
+    order = referee_match_order(df)
 
     # STEP 2 — consistency bonuses
-    bonuses = compute_consistency_bonus(df)
-    df["final_rating"] += df.index.map(bonuses)
+    bonuses = compute_consistency_bonus(df, order)
+    df["final_rating"] = df["final_rating"].to_numpy() + bonuses
 
     # STEP 3 — season + form
-    form_map, season_map = compute_form_and_season(df)
-    df["form_5_games"] = df.index.map(form_map)
-    df["season_average"] = df["referee"].map(season_map)
+    form, season = compute_form_and_season(df, order)
+    df["form_5_games"] = round_like_builtin(form, 2)
+    df["season_average"] = np.round(season, 2)
 
     return df
 